@@ -1,2 +1,3 @@
 SCHEDULER_NAME = 'chakra'
-CLUSTER_STATE_RECOVERY_INTERVAL = 3
\ No newline at end of file
+CLUSTER_STATE_RECOVERY_INTERVAL = 3
+CLUSTER_STATE_MAX_BACKOFF = 30 # Maximum seconds to wait before relisting after repeated API failures
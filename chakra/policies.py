@@ -1,12 +1,14 @@
 # Implements various Chakra policies for allocating jobs to nodes
-import copy
 import logging
+from bisect import bisect_left, insort
 from typing import Dict, Union
 
 import random
 
 from kubernetes.client import V1Pod
 
+from chakra.resources import parse_pod_requests
+
 logger = logging.getLogger(__name__)
 
 class BasePolicy:
@@ -25,11 +27,27 @@ class BasePolicy:
 
         Hint: Can access labels using event_obj.metadata.labels
         :param cluster_state: Dictionary containing the current state of the cluster. Structure is {node_name: {cpu: float, mem: float, nvidia.com/gpu: float}}
+            It is shared with the scheduler and must not be modified in place, use subtract_resources to get the speculated cluster_state.
         :param pod: V1Pod object to be scheduled
         :return: Node name to allocate the pod to and the cluster_state if the node allocation succeeds (speculated).
         """
         raise NotImplementedError
 
+    @staticmethod
+    def subtract_resources(cluster_state: Dict[str, Dict[str, Union[float, int]]],
+                           node: str,
+                           requests: Dict[str, Union[float, int]]) -> Dict[str, Dict[str, Union[float, int]]]:
+        """
+        Returns a copy of cluster_state with requests subtracted from the resources of node. The copy is copy-on-write:
+        only the dictionary of node is copied and the dictionaries of all other nodes are shared with cluster_state.
+        """
+        node_resources = dict(cluster_state[node])
+        for resource, amount in requests.items():
+            node_resources[resource] -= amount
+        new_cluster_state = dict(cluster_state)
+        new_cluster_state[node] = node_resources
+        return new_cluster_state
+
 
 class RandomPolicy(BasePolicy):
     """Randomly allocates jobs to nodes. Does not check if the node has enough resources."""
@@ -60,6 +78,39 @@ class BestfitBinpackPolicy(BasePolicy):
             )
         self.binpacking_resource = binpacking_resource
 
+        # Nodes sorted by available amount of a resource, kept for the last cluster_state seen. Structure is
+        # {resource: [(available, node_order, node_name)]}. node_order is the position of the node in the
+        # cluster_state and breaks ties in favour of the first node.
+        self._indexed_cluster_state = None
+        self._indexes = {}
+        self._node_order = {}
+
+    def _get_index(self, cluster_state: Dict[str, Dict[str, Union[float, int]]], resource: str):
+        """
+        Returns the nodes sorted by their available amount of resource. The index is built once per
+        cluster_state and reused until a different cluster_state is passed in.
+        """
+        if cluster_state is not self._indexed_cluster_state:
+            self._indexed_cluster_state = cluster_state
+            self._indexes = {}
+            self._node_order = {node: order for order, node in enumerate(cluster_state)}
+        index = self._indexes.get(resource)
+        if index is None:
+            index = sorted((resources.get(resource, 0), self._node_order[node], node)
+                           for node, resources in cluster_state.items())
+            self._indexes[resource] = index
+        return index
+
+    def _update_indexes(self, predicted_cluster_state: Dict[str, Dict[str, Union[float, int]]], node: str):
+        """ Moves node to its new position in the cached indexes and makes them track predicted_cluster_state. """
+        old_resources = self._indexed_cluster_state[node]
+        new_resources = predicted_cluster_state[node]
+        order = self._node_order[node]
+        for resource, index in self._indexes.items():
+            del index[bisect_left(index, (old_resources.get(resource, 0), order, node))]
+            insort(index, (new_resources.get(resource, 0), order, node))
+        self._indexed_cluster_state = predicted_cluster_state
+
     def get_allocation(self,
                        cluster_state: Dict[str, Dict[str, Union[float, int]]],
                        pod: V1Pod) -> str:
@@ -71,41 +122,52 @@ class BestfitBinpackPolicy(BasePolicy):
         """
         # Initially, use the binpacking_resource defined for the class
         binpacking_resource = self.binpacking_resource
-        # Get the pod resource requirement
-        if pod.spec.containers[0].resources and pod.spec.containers[0].resources.requests:
-            pod_resource_req = pod.spec.containers[0].resources.requests.get(binpacking_resource)
+        # Get the pod resource requirement. Quantities (e.g. '500m', '1Gi') are parsed once per pod.
+        pod_requests = parse_pod_requests(pod)
+        logger.debug('Pod requests %s', pod_requests)
+        pod_resource_req = pod_requests.get(binpacking_resource)
 
         # Fall back to CPU if the specified binpacking resource is not requested by the pod
         if pod_resource_req is None:
-            pod_resource_req = pod.spec.containers[0].resources.requests.get(
-                'cpu')
+            pod_resource_req = pod_requests.get('cpu')
             if pod_resource_req is None:
                 raise Exception('Pod does not have a resource request for cpu')
             # Also fall back the binpacking resource to CPU for checking in the cluster_state
             logger.warning(f'Falling back to CPU since pod does not have a resource request for {binpacking_resource}')
             binpacking_resource = 'cpu'
 
-        pod_resource_req = float(pod_resource_req)
-
-        # Find the best fit node
+        # Find the best fit node, i.e. the node with the least binpacking resource remaining after fitting the pod.
+        # Nodes are scanned in increasing order of the binpacking resource starting from the first one that
+        # has enough of it, so the first node where all other requested resources fit is the best fit.
+        index = self._get_index(cluster_state, binpacking_resource)
+        # Nodes past the bisection point always fit the binpacking resource, so only check the other resources.
+        other_requests = [(resource, amount) for resource, amount in pod_requests.items()
+                          if resource != binpacking_resource]
+        start = bisect_left(index, (pod_resource_req,))
         best_fit_node = None
-        best_fit_node_remaining = None
-        for node, resources in cluster_state.items():
-            print(list(pod.spec.containers[0].resources.requests.keys()))
-            if all(float(resources.get(resource, 0)) >= float(pod.spec.containers[0].resources.requests.get(resource, 0))
-                   for resource in pod.spec.containers[0].resources.requests.keys()):
-                remaining_resource = resources.get(binpacking_resource) - pod_resource_req
-                if remaining_resource >= 0 and (best_fit_node is None or remaining_resource < best_fit_node_remaining):
+        if not other_requests:
+            # Common case of a pod requesting only the binpacking resource, the first node past the bisection point fits
+            if start < len(index):
+                best_fit_node = index[start][2]
+        else:
+            for i in range(start, len(index)):
+                node = index[i][2]
+                resources = cluster_state[node]
+                # Plain loop instead of all() over a generator, which would allocate a generator for every node
+                for resource, amount in other_requests:
+                    if resources.get(resource, 0) < amount:
+                        break
+                else:
                     best_fit_node = node
-                    best_fit_node_remaining = remaining_resource
+                    break
 
         if best_fit_node is None:
             raise Exception('No node has enough resources to fit the pod')
 
-        predicted_cluster_state = copy.deepcopy(cluster_state)
         # Update the cluster state for all resources
-        for resource in pod.spec.containers[0].resources.requests.keys():
-            predicted_cluster_state[best_fit_node][resource] -= float(pod.spec.containers[0].resources.requests.get(resource))
+        predicted_cluster_state = self.subtract_resources(cluster_state, best_fit_node, pod_requests)
+        # The scheduler passes the predicted cluster state to the next allocation, so keep the index in sync with it
+        self._update_indexes(predicted_cluster_state, best_fit_node)
 
         return best_fit_node, predicted_cluster_state
 
@@ -0,0 +1,75 @@
+# Parsing of Kubernetes resource quantities into the units used in the cluster state
+import functools
+from typing import Dict, Optional
+
+from kubernetes.client import V1Pod
+
+_CPU_UNITS = {'m': 1e-3, 'K': 1e3}
+_MEMORY_UNITS = {'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40}
+
+
+def _split_quantity(quantity: str):
+    """ Split a quantity string such as '500m' into its numeric value and unit suffix. """
+    i = 0
+    n = len(quantity)
+    while i < n and (quantity[i].isdigit() or quantity[i] == '.'):
+        i += 1
+    return float(quantity[:i]), quantity[i:]
+
+
+# Parsed values are cached since the same few request strings (e.g. '100m', '512Mi') repeat across pods.
+@functools.lru_cache(maxsize=4096)
+def parse_resource_cpu(resource_str):
+    """ Parse CPU string to cpu count. """
+    value, unit = _split_quantity(resource_str)
+    return value * _CPU_UNITS.get(unit, 1)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_resource_memory(resource_str):
+    """ Parse resource string to megabytes. """
+    value, unit = _split_quantity(resource_str)
+    return value * _MEMORY_UNITS.get(unit, 1) / (
+                2 ** 20)  # Convert to megabytes
+
+
+# Resources tracked in the cluster state. Requests for any other resource (e.g. ephemeral-storage) cannot be checked
+# against the cluster state and are ignored.
+TRACKED_RESOURCES = ('cpu', 'memory', 'nvidia.com/gpu')
+
+
+def parse_resource(resource: str, quantity) -> Optional[float]:
+    """ Parse the requested quantity of a resource. CPU is parsed to cpu count, memory to megabytes and
+    nvidia.com/gpu to a plain number. Returns None for resources which are not tracked. """
+    if resource == 'cpu':
+        return parse_resource_cpu(str(quantity))
+    if resource == 'memory':
+        return parse_resource_memory(str(quantity))
+    if resource in TRACKED_RESOURCES:
+        return float(quantity)
+    return None
+
+
+# Parsed requests of pods keyed by pod uid. Requests of a pod are immutable, so entries never go stale. They are
+# removed with forget_pod_requests once the pod no longer waits to be scheduled.
+_pod_requests_cache: Dict[str, Dict[str, float]] = {}
+
+
+def parse_pod_requests(pod: V1Pod) -> Dict[str, float]:
+    """ Parse the requests of the first container of the pod, which is what policies schedule on.
+    Results are cached by pod uid, so a pod which is retried is parsed only once. """
+    uid = pod.metadata.uid if pod.metadata else None
+    requests = _pod_requests_cache.get(uid) if uid else None
+    if requests is None:
+        container_resources = pod.spec.containers[0].resources
+        reqs = container_resources.requests if container_resources and container_resources.requests else {}
+        requests = {resource: parse_resource(resource, quantity) for resource, quantity in reqs.items()
+                    if resource in TRACKED_RESOURCES}
+        if uid:
+            _pod_requests_cache[uid] = requests
+    return requests
+
+
+def forget_pod_requests(uid: str):
+    """ Drop the cached requests of a pod, e.g. once it was bound or deleted. """
+    _pod_requests_cache.pop(uid, None)
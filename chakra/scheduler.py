@@ -1,34 +1,54 @@
 # The main Chakra scheduler class. This class is responsible for scheduling pods to nodes.
 
+import heapq
+import itertools
 import json
 import logging
-import re
 import threading
 import time
-from collections import deque
-from typing import Optional, Dict
+from collections import defaultdict
+from typing import Optional, Dict, List
 
 from kubernetes.client import V1Pod
 
 from chakra.policies import BasePolicy
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG, #CRITICAL or INFO
-                    format='%(asctime)s | %(levelname)-6s | %(name)-40s || %(message)s',
-                    datefmt='%m-%d %H:%M:%S'
-                    )
 
 from kubernetes import client, config, watch
-from chakra import constants, policies
+from chakra import constants, policies, resources
 
 client.rest.logger.setLevel(logging.WARNING)
 
+
+class RawWatch(watch.Watch):
+    """
+    Watch which yields the objects of events as raw json dicts. watch.Watch deserializes every object into a
+    kubernetes model, and even with return_type='object' it still dumps and reloads the json of every event.
+    """
+
+    def unmarshal_event(self, data, return_type):
+        event = json.loads(data)
+        event['raw_object'] = event['object']
+        if event['type'] not in ('ERROR', 'BOOKMARK'):
+            # Resume from the last event seen if the stream is reconnected
+            self.resource_version = event['object']['metadata']['resourceVersion']
+        return event
+
+
 class ClusterStateUpdater(threading.Thread):
     """
-    Thread to update the cluster state periodically.
+    Thread to maintain the cluster state and publish it to the scheduler whenever it changes.
+
+    Allocatable resources of nodes and resources requested by pods are cached in memory. The cache is
+    populated by listing nodes and pods once and then kept up to date incrementally from watch events,
+    so the apiserver is only listed again when a watch is dropped.
     """
 
     PRINT_FREQUENCY = 5 # Seconds between printing cluster state
+    RECONCILE_INTERVAL = 30 # Maximum seconds between publishing the cached cluster state, even if no change was seen
+    LIST_PAGE_SIZE = 500 # Number of objects fetched per page when listing nodes and pods
+    WATCH_HEALTHY_INTERVAL = 60 # Seconds a watch must stay up before the relist backoff is reset
     def __init__(self, chakra_obj, kubecoreapi, namespace):
         super().__init__()
         self.chakra_obj = chakra_obj
@@ -37,94 +57,302 @@ class ClusterStateUpdater(threading.Thread):
         self.daemon = True
         self.last_print_time = 0
 
+        # All caches below are guarded by _lock since they are mutated by the watcher threads.
+        self._lock = threading.Lock()
+        self._node_totals = {}  # Allocatable resources per node. Structure is {node_name: {cpu: float, memory: float, nvidia.com/gpu: int}}
+        self._node_used = {}  # Resources requested by accounted pods per node. Same structure as _node_totals.
+        self._accounted_pods = {}  # Pods whose requests are included in _node_used. Structure is {pod_uid: (node_name, requests)}
+        self._pods_accounted = threading.Condition(self._lock)  # Notified when pods are added to _accounted_pods
+        self._expected_pods = {}  # Pods the scheduler is binding, with whether the binding was observed. Structure is {pod_uid: bool}
+        self._dirty = threading.Event()  # Set by the watcher threads when the cached cluster state changed
+        self._capacity_freed = False  # Set when resources may have been freed since the last publish, e.g. a pod finished or a node was added
+        self._nodes_synced = threading.Event()
+        self._pods_synced = threading.Event()
 
     def run(self):
+        threading.Thread(target=self._watch, args=(self.kubecoreapi.list_node_with_http_info,
+                                                   self.kubecoreapi.list_node,
+                                                   self._sync_nodes, self._handle_node_event,
+                                                   self._nodes_synced),
+                         daemon=True).start()
+        # Only pods which can use resources in our namespace are listed and watched. Pods which finish
+        # no longer match the field selector and are delivered as DELETED events.
+        pod_field_selector = f'status.phase!=Succeeded,status.phase!=Failed,metadata.namespace={self.namespace}'
+        threading.Thread(target=self._watch, args=(self.kubecoreapi.list_pod_for_all_namespaces_with_http_info,
+                                                   self.kubecoreapi.list_pod_for_all_namespaces,
+                                                   self._sync_pods, self._handle_pod_event,
+                                                   self._pods_synced),
+                         kwargs={'field_selector': pod_field_selector},
+                         daemon=True).start()
+        self._nodes_synced.wait()
+        self._pods_synced.wait()
         while True:
+            # Publish only when the watchers changed the cache. The timeout publishes periodically regardless, as a
+            # safety net for reconciliation.
+            self._dirty.wait(timeout=self.RECONCILE_INTERVAL)
+            self._dirty.clear()
+            with self._lock:
+                capacity_freed = self._capacity_freed
+                self._capacity_freed = False
             try:
                 cluster_state = self.get_cluster_state()
                 self.chakra_obj.set_cluster_state(cluster_state)
+                if capacity_freed:
+                    # Waiting pods may fit now. The scheduler reads the cache for every batch, so the retried pods see
+                    # the freed resources.
+                    self.chakra_obj.retry_waiting_pods()
                 # If more time has passed than the print frequency, print the cluster state
                 if time.time() - self.last_print_time > self.PRINT_FREQUENCY:
-                    logger.info(f'Cluster state: {str(cluster_state)}')
+                    logger.info('Cluster state: %s', cluster_state)
                     self.last_print_time = time.time()
             except Exception as e:
                 logger.exception(f'Exception in ClusterStateUpdater: {e}.\n Retrying in {constants.CLUSTER_STATE_RECOVERY_INTERVAL} seconds.')
                 time.sleep(constants.CLUSTER_STATE_RECOVERY_INTERVAL)
+                with self._lock:
+                    self._capacity_freed |= capacity_freed
+                self._dirty.set()
 
-    @staticmethod
-    def parse_resource_cpu(resource_str):
-        """ Parse CPU string to cpu count. """
-        unit_map = {'m': 1e-3, 'K': 1e3}
-        value = re.search(r'\d+', resource_str).group()
-        unit = resource_str[len(value):]
-        return float(value) * unit_map.get(unit, 1)
+    def _watch(self, list_func, watch_func, sync, handle_event, synced: threading.Event, **kwargs):
+        """
+        Lists all objects to (re)build the cache and then applies watch events to it. If the watch is
+        dropped, the objects are listed again. An expired resource version (410 Gone) is relisted right away,
+        other failures back off exponentially so a struggling apiserver is not flooded with relists.
+        :param list_func: The *_with_http_info list function used for the paginated initial list.
+        :param watch_func: The list function to watch.
+        :param sync: Called with the listed objects to replace the cached state.
+        :param handle_event: Called with the event type and object for every watch event.
+        :param synced: Set once the cache has been populated for the first time.
+        :param kwargs: Additional arguments, e.g. field_selector, passed to both list_func and watch_func.
+        """
+        backoff = constants.CLUSTER_STATE_RECOVERY_INTERVAL
+        while True:
+            watch_started = None
+            try:
+                objects, resource_version = self._list_all(list_func, **kwargs)
+                with self._lock:
+                    sync(objects)
+                synced.set()
+                watch_started = time.time()
+                # Events are kept as raw dicts instead of being deserialized into kubernetes model objects
+                w = RawWatch()
+                for event in w.stream(watch_func, resource_version=resource_version, **kwargs):
+                    with self._lock:
+                        handle_event(event['type'], event['object'])
+            except Exception as e:
+                if isinstance(e, client.rest.ApiException) and e.status == 410:
+                    # The resource version expired, which is routine. Relist right away.
+                    logger.info(f'Resource version expired in {watch_func.__name__} watch, relisting.')
+                    continue
+                # Only a watch which stayed up for a while resets the backoff, so a watch which fails right after
+                # every successful list still backs off.
+                if watch_started is not None and time.time() - watch_started >= self.WATCH_HEALTHY_INTERVAL:
+                    backoff = constants.CLUSTER_STATE_RECOVERY_INTERVAL
+                if isinstance(e, client.rest.ApiException):
+                    logger.warning(f'API Exception in {watch_func.__name__} watch: {e.status} {e.reason}. Relisting in {backoff} seconds.')
+                else:
+                    logger.exception(f'Exception in {watch_func.__name__} watch: {e}.\n Relisting in {backoff} seconds.')
+                time.sleep(backoff)
+                backoff = min(backoff * 2, constants.CLUSTER_STATE_MAX_BACKOFF)
+
+    def _list_all(self, list_func, **kwargs):
+        """
+        List all objects page by page. Returns the objects and the resource version of the list.
+        The response is parsed with json directly and objects are returned as raw dicts, which is much cheaper
+        than deserializing them into kubernetes model objects.
+        """
+        objects = []
+        # resource_version='0' lets the apiserver serve the first page from its watch cache instead of etcd.
+        # It must not be set together with a continue token, so it is dropped for subsequent pages.
+        page_kwargs = {'resource_version': '0'}
+        while True:
+            response, _, _ = list_func(limit=self.LIST_PAGE_SIZE,
+                                       _preload_content=False,
+                                       **page_kwargs,
+                                       **kwargs)
+            object_list = json.loads(response.data)
+            objects.extend(object_list['items'])
+            continue_token = object_list['metadata'].get('continue')
+            if not continue_token:
+                return objects, object_list['metadata']['resourceVersion']
+            page_kwargs = {'_continue': continue_token}
+
+    # The list and watch handlers below receive nodes and pods as raw json dicts.
+    def _sync_nodes(self, nodes):
+        self._node_totals = {node['metadata']['name']: self.get_node_allocatable(node['status']['allocatable'])
+                             for node in nodes}
+        # Nodes may have been added or grown while the watch was down
+        self._capacity_freed = True
+        self._dirty.set()
+
+    def _handle_node_event(self, event_type, node):
+        name = node['metadata']['name']
+        if event_type == 'DELETED':
+            self._node_totals.pop(name, None)
+            self._dirty.set()
+            return
+        totals = self.get_node_allocatable(node['status']['allocatable'])
+        # Most node updates only change status fields (conditions, images, heartbeats), not allocatable resources
+        if self._node_totals.get(name) != totals:
+            logger.info(f'Allocatable resources of node {name} changed to {totals}.')
+            self._node_totals[name] = totals
+            self._capacity_freed = True
+            self._dirty.set()
+
+    def _sync_pods(self, pods):
+        # Rebuild the per node usage from scratch so pods which disappeared while the watch was down are
+        # dropped and nothing is double counted. Pods are grouped by node in a single pass, and pods which
+        # were already accounted for reuse their parsed requests since requests of a pod are immutable.
+        accounted_pods = {}
+        pods_by_node = defaultdict(list)
+        for pod in pods:
+            node_name = pod['spec'].get('nodeName')
+            if node_name is None:
+                continue
+            uid = pod['metadata']['uid']
+            accounted = self._accounted_pods.get(uid)
+            requests = accounted[1] if accounted else self._get_raw_pod_requests(pod)
+            accounted_pods[uid] = (node_name, requests)
+            if uid in self._expected_pods:
+                self._expected_pods[uid] = True
+            pods_by_node[node_name].append(requests)
+
+        self._accounted_pods = accounted_pods
+        self._node_used = {
+            node_name: {resource: sum(requests[resource] for requests in node_requests)
+                        for resource in node_requests[0]}
+            for node_name, node_requests in pods_by_node.items()
+        }
+        # Pods may have finished while the watch was down
+        self._capacity_freed = True
+        self._pods_accounted.notify_all()
+        self._dirty.set()
+
+    def _handle_pod_event(self, event_type, pod):
+        if event_type == 'DELETED':
+            self._remove_pod(pod['metadata']['uid'])
+        else:
+            self._add_pod(pod)
+
+    def _add_pod(self, pod):
+        uid = pod['metadata']['uid']
+        node_name = pod['spec'].get('nodeName')
+        # Pods not bound to a node do not use any resources yet. Requests of a pod are immutable,
+        # so a pod which is already accounted for never needs to be updated.
+        if node_name is None or uid in self._accounted_pods:
+            return
+        requests = self._get_raw_pod_requests(pod)
+        self._accounted_pods[uid] = (node_name, requests)
+        if uid in self._expected_pods:
+            self._expected_pods[uid] = True
+        used = self._node_used.setdefault(node_name, dict.fromkeys(requests, 0))
+        for resource, value in requests.items():
+            used[resource] += value
+        self._pods_accounted.notify_all()
+        self._dirty.set()
+
+    def _remove_pod(self, uid):
+        accounted = self._accounted_pods.pop(uid, None)
+        if accounted is None:
+            return
+        node_name, requests = accounted
+        used = self._node_used[node_name]
+        for resource, value in requests.items():
+            used[resource] -= value
+        self._capacity_freed = True
+        self._dirty.set()
+
+    def expect_pods(self, uids):
+        """
+        Registers pods which are about to be bound. Their bindings are recorded once observed, so wait_for_pods
+        returns even if a pod finished or was deleted again before it was called.
+        """
+        with self._lock:
+            for uid in uids:
+                self._expected_pods[uid] = uid in self._accounted_pods
 
-    @staticmethod
-    def parse_resource_memory(resource_str):
-        """ Parse resource string to megabytes. """
-        unit_map = {'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40}
-        value = re.search(r'\d+', resource_str).group()
-        unit = resource_str[len(value):]
-        return float(value) * unit_map.get(unit, 1) / (
-                    2 ** 20)  # Convert to megabytes
+    def forget_expected_pods(self, uids):
+        """ Unregisters pods passed to expect_pods which will not be waited for, e.g. because their binding failed. """
+        with self._lock:
+            for uid in uids:
+                self._expected_pods.pop(uid, None)
+
+    def wait_for_pods(self, uids, timeout: float) -> bool:
+        """
+        Blocks till the bindings of the pods, which must have been passed to expect_pods, have been observed by the
+        watch. The pods are unregistered afterwards.
+        :return: False if timeout seconds passed before all bindings were observed, else True.
+        """
+        with self._pods_accounted:
+            try:
+                return self._pods_accounted.wait_for(lambda: all(self._expected_pods.get(uid, True) for uid in uids),
+                                                     timeout)
+            finally:
+                for uid in uids:
+                    self._expected_pods.pop(uid, None)
+
+    parse_resource_cpu = staticmethod(resources.parse_resource_cpu)
+    parse_resource_memory = staticmethod(resources.parse_resource_memory)
+
+    @classmethod
+    def get_node_allocatable(cls, allocatable: Dict[str, str]) -> Dict[str, float]:
+        """ Parse the allocatable resources of a node, i.e. node.status.allocatable. """
+        return {
+            'cpu': cls.parse_resource_cpu(allocatable['cpu']),
+            'memory': cls.parse_resource_memory(allocatable['memory']),
+            'nvidia.com/gpu': int(allocatable.get('nvidia.com/gpu', 0))
+        }
+
+    @classmethod
+    def _get_raw_pod_requests(cls, pod: Dict) -> Dict[str, float]:
+        """ Get resources requested by all containers of a pod given as a raw json dict. """
+        return cls.sum_requests(container.get('resources', {}).get('requests')
+                                for container in pod['spec']['containers'])
+
+    @classmethod
+    def sum_requests(cls, container_requests) -> Dict[str, float]:
+        """ Sum resources requested by containers. container_requests yields the requests dict (or None) of each container. """
+        # Bind the parsers to locals once instead of looking them up on the class for every container
+        parse_cpu = cls.parse_resource_cpu
+        parse_memory = cls.parse_resource_memory
+        used_cpu = 0
+        used_memory = 0
+        used_gpu = 0
+        for requests in container_requests:
+            if requests:
+                get = requests.get
+                used_cpu += parse_cpu(get('cpu', '0m'))
+                used_memory += parse_memory(get('memory', '0Mi'))
+                used_gpu += int(get('nvidia.com/gpu', 0))
+        return {
+            'cpu': used_cpu,
+            'memory': used_memory,
+            'nvidia.com/gpu': used_gpu
+        }
 
     def get_cluster_state(self) -> Dict[str, Dict[str, int]]:
-        """ Get allocatable resources per node. """
-        # Get the nodes and running pods
-
-        limit = None
-        continue_token = ""
-        nodes, _, _ = self.kubecoreapi.list_node_with_http_info(limit=limit,
-                                                            _continue=continue_token)
-        pods, _, _ = self.kubecoreapi.list_pod_for_all_namespaces_with_http_info(
-            limit=limit, _continue=continue_token)
-
-        nodes = nodes.items
-        pods = pods.items
-
-        available_resources = {}
-        running_pods = set()
-
-        for node in nodes:
-            name = node.metadata.name
-            total_cpu = self.parse_resource_cpu(node.status.allocatable['cpu'])
-            total_memory = self.parse_resource_memory(
-                node.status.allocatable['memory'])
-            total_gpu = int(node.status.allocatable.get('nvidia.com/gpu', 0))
-
-            used_cpu = 0
-            used_memory = 0
-            used_gpu = 0
-
-            for pod in pods:
-                if pod.spec.node_name == name and pod.status.phase in ['Running', 'Pending'] and pod.metadata.namespace == 'default':
-                    running_pods.add(pod.metadata.name)
-                    for container in pod.spec.containers:
-                        if container.resources.requests:
-                            used_cpu += self.parse_resource_cpu(
-                                container.resources.requests.get('cpu', '0m'))
-                            used_memory += self.parse_resource_memory(
-                                container.resources.requests.get('memory',
-                                                                 '0Mi'))
-                            used_gpu += int(container.resources.requests.get(
-                                'nvidia.com/gpu', 0))
-
-            available_cpu = total_cpu - used_cpu
-            available_memory = total_memory - used_memory
-            available_gpu = total_gpu - used_gpu
-
-            available_resources[name] = {
-                'cpu': available_cpu,
-                'memory': available_memory,
-                'nvidia.com/gpu': available_gpu
-            }
-        return available_resources
+        """ Get available resources per node from the cache. """
+        cluster_state = {}
+        with self._lock:
+            node_used = self._node_used
+            for name, totals in self._node_totals.items():
+                used = node_used.get(name)
+                if used is None:
+                    cluster_state[name] = dict(totals)
+                else:
+                    cluster_state[name] = {resource: total - used[resource] for resource, total in totals.items()}
+        return cluster_state
 
 
 class ChakraScheduler:
     """
     The main Chakra scheduler class. This class watches cluster state and schedules pods to nodes.
     """
+
+    BATCH_MEMORY_WEIGHT = 1 / 1024 # Weight of a megabyte of memory relative to a cpu when ordering pods by size in a batch
+    MAX_RETRY_BACKOFF = 30 # Maximum seconds to wait before retrying a pod which could not be placed
+    BINDING_THREADS = 8 # Number of bindings which can be in flight at the same time
+    BINDING_WAIT_TIMEOUT = 10 # Maximum seconds to wait for bound pods to show up in the cluster state after a batch
+    FINAL_BINDING_STATUSES = (404, 409) # Binding failures which are not retried, the pod was deleted or is already bound
     def __init__(self,
                  kube_config_path: str = '',
                  policy: Optional[BasePolicy] = None,
@@ -144,20 +372,48 @@ class ChakraScheduler:
             except config.config_exception.ConfigException:
                 logger.error('Failed to load in-cluster config.')
                 raise
-        self.kubecoreapi = client.CoreV1Api()
-        self.scheduler_name = constants.SCHEDULER_NAME
+        # pool_threads sets how many requests made with async_req=True, i.e. bindings, can run concurrently.
+        self.kubecoreapi = client.CoreV1Api(client.ApiClient(pool_threads=self.BINDING_THREADS))
         logger.info('Scheduler Pre-init done.')
-        self.cluster_state = None # Dictionary containing the current state of the cluster. Structure is {node_name: {cpu: float, mem: float, nvidia.com/gpu: float}}
+        self._init_scheduling_state()
 
         # Run a thread to periodically fetch current state of the cluster and update the cluster state.
         self.cluster_state_updater = ClusterStateUpdater(self, self.kubecoreapi, self.namespace)
         self.cluster_state_updater.start()
 
+    def _init_scheduling_state(self):
+        """ Initializes the cluster state and the queue of waiting pods. Does not talk to the cluster. """
+        self.scheduler_name = constants.SCHEDULER_NAME
+        self.cluster_state = None # Dictionary containing the current state of the cluster. Structure is {node_name: {cpu: float, mem: float, nvidia.com/gpu: float}}
+        self._state_lock = threading.RLock()  # Held while a batch is placed, so the speculated cluster_state is not replaced halfway
+
+        # Pods waiting to be scheduled. This is a heap of (next_attempt_time, -pod_priority, seq, event) entries, so due
+        # pods are tried first and higher priority pods are tried before lower priority ones. Guarded by _queue_cv.
+        self._waiting_pods = []
+        self._queue_cv = threading.Condition()
+        self._seq = itertools.count()
+        self._queued_seq = {}  # Seq of the latest queued entry per pod, older entries are stale. Structure is {pod_uid: seq}
+        self._failed_attempts = {}  # Failed scheduling attempts per pod, used for the retry backoff. Structure is {pod_uid: int}
+        self._pending_bindings = []  # Bindings issued in the current batch. Structure is [(event, AsyncResult)]
+
     def set_cluster_state(self, cluster_state: Dict):
-        # Called by the ClusterStateUpdater thread.
-        self.cluster_state = cluster_state
+        # Called by the ClusterStateUpdater thread, and with speculated cluster states while placing a batch.
+        # Cluster states are never modified in place, readers get a consistent view by reading self.cluster_state once.
+        with self._state_lock:
+            self.cluster_state = cluster_state
+
+    def retry_waiting_pods(self):
+        """ Makes all waiting pods due immediately. Called by the ClusterStateUpdater when resources were freed. """
+        with self._queue_cv:
+            self._waiting_pods = [(0, *entry[1:]) for entry in self._waiting_pods]
+            heapq.heapify(self._waiting_pods)
+            self._queue_cv.notify()
 
     def schedule(self, name, node):
+        """
+        Binds the pod to the node. The binding is sent asynchronously so the bindings of a batch are in flight
+        concurrently, use the returned AsyncResult to wait for it.
+        """
         logger.info('Scheduling object %s on node %s.' % (str(name), str(node)))
 
         target = client.V1ObjectReference()
@@ -170,34 +426,57 @@ class ChakraScheduler:
 
         body = client.V1Binding(metadata=meta, target=target)
 
-        result = False
-        try:
-            result = self.kubecoreapi.create_namespaced_binding(self.namespace, body)
-        except ValueError as e: #TODO(romilb): Hack till kub-python fixes their api.
-            if str(e) != 'Invalid value for `target`, must not be `None`':
-                raise
-            else:
-                logger.info('Recieved response from API, but no target value... ignoring exception.')
+        return self.kubecoreapi.create_namespaced_binding(self.namespace, body, async_req=True)
 
-        # Block till the pod is scheduled
-        last_print_time = 0
-        block_start_time = time.time()
-        while True:
-            pod = self.kubecoreapi.read_namespaced_pod(name=name, namespace=self.namespace)
-            if pod.status.phase != 'Pending':
-                break
-            time.sleep(0.05)
-            now = time.time()
-            if now - last_print_time > 1:
-                logger.info(f'Waiting for pod {name} to be scheduled since {now - block_start_time:.2f} seconds.')
-                last_print_time = time.time()
-        return result
+    def _wait_for_bindings(self) -> List[Dict]:
+        """
+        Waits for the bindings issued in the current batch to complete and for the bound pods to show up in the
+        cluster state. Waiting on the cluster state cache replaces polling the apiserver for every pod.
+        :return: Events of the pods whose binding failed and which should be retried.
+        """
+        # Take the bindings first, so they are never collected twice even if something below raises
+        pending_bindings, self._pending_bindings = self._pending_bindings, []
+        bound_uids = []
+        failed_events = []
+        for event, async_result in pending_bindings:
+            pod = event['object']
+            try:
+                async_result.get()
+                bound_uids.append(pod.metadata.uid)
+            except ValueError as e: #TODO(romilb): Hack till kub-python fixes their api.
+                if str(e) != 'Invalid value for `target`, must not be `None`':
+                    logger.exception(f'Failed to bind pod {pod.metadata.name}: {e}')
+                    failed_events.append(event)
+                else:
+                    logger.info('Recieved response from API, but no target value... ignoring exception.')
+                    bound_uids.append(pod.metadata.uid)
+            except client.rest.ApiException as e:
+                logger.warning(f'API Exception while binding pod {pod.metadata.name}: {e.status} {e.reason}')
+                if e.status not in self.FINAL_BINDING_STATUSES:
+                    failed_events.append(event)
+            except Exception as e:
+                # E.g. connection errors. Keep collecting the remaining bindings.
+                logger.exception(f'Failed to bind pod {pod.metadata.name}: {e}')
+                failed_events.append(event)
+        pending_uids = [event['object'].metadata.uid for event, _ in pending_bindings]
+        bound = set(bound_uids)
+        self.cluster_state_updater.forget_expected_pods([uid for uid in pending_uids if uid not in bound])
+        # Pods which are not retried left the wait queue
+        failed_uids = {event['object'].metadata.uid for event in failed_events}
+        for uid in pending_uids:
+            if uid not in failed_uids:
+                self._forget_pod(uid)
+
+        # Block till the bound pods are accounted for, so the next published cluster state includes them
+        if not self.cluster_state_updater.wait_for_pods(bound_uids, timeout=self.BINDING_WAIT_TIMEOUT):
+            logger.warning(f'Bound pods did not show up in the cluster state after {self.BINDING_WAIT_TIMEOUT} seconds.')
+        return failed_events
 
     def process_event(self, event: Dict):
         """
         Processes the event and schedules the job.
-        :param event: Dict containing 'object', 'raw_object'. 'object' is the V1Pod object and 'raw_object' is the raw json object.
-        :return: None if the event was scheduled, else the event object.
+        :param event: Dict containing 'type' and 'object'. 'object' is the V1Pod object, slimmed down by slim_pod.
+        :return: None if the binding was sent (or the pod cannot be bound anymore), else the event object.
         """
         pod: V1Pod = event['object']
         try:
@@ -206,7 +485,7 @@ class ChakraScheduler:
                 allotted_node_name, speculated_cluster_state = self.policy.get_allocation(self.cluster_state, pod)
                 logger.info(
                     'Got allocation node - %s' % str(allotted_node_name))
-                logger.info('Speculated cluster state - %s' % str(speculated_cluster_state))
+                logger.info('Speculated cluster state - %s', speculated_cluster_state)
                 # We speculatively update the cluster state here. This will be overwritten by the ClusterStateUpdater thread when the real cluster state comes in.
                 # This is to prevent the scheduler from scheduling multiple pods to the same node when it is not aware of the real cluster state.
                 self.set_cluster_state(speculated_cluster_state)
@@ -214,49 +493,171 @@ class ChakraScheduler:
                 logger.exception(
                     'Unable to allocate %s: %s, adding it back to the wait queue.' % (pod.metadata.name, str(e)))
                 return event
-            res = self.schedule(pod.metadata.name,
-                                allotted_node_name)
+            # Registered before the binding is sent, so the binding cannot be observed before the updater looks for it
+            self.cluster_state_updater.expect_pods([pod.metadata.uid])
+            async_result = self.schedule(pod.metadata.name,
+                                         allotted_node_name)
+            self._pending_bindings.append((event, async_result))
         except client.rest.ApiException as e:
-            logger.warning('API Exception - %s' % str(json.loads(e.body)['message']))
+            logger.warning(f'API Exception while binding pod {pod.metadata.name}: {e.status} {e.reason}')
+            self.cluster_state_updater.forget_expected_pods([pod.metadata.uid])
+            if e.status not in self.FINAL_BINDING_STATUSES:
+                return event
 
 
-    def run(self):
-        # Wait for cluster state to be populated once before starting the scheduler.
-        while self.cluster_state is None:
-            logger.info('Waiting for cluster state to be populated.')
-            time.sleep(1)
-        logger.info('Cluster state populated, starting scheduler.')
+    @staticmethod
+    def slim_pod(pod: V1Pod) -> V1Pod:
+        """
+        Returns a copy of the pod with only the fields used for scheduling. Managed fields, volumes, env, status
+        conditions etc. are dropped, which keeps the memory used by waiting pods small.
+        """
+        return V1Pod(
+            metadata=client.V1ObjectMeta(name=pod.metadata.name,
+                                         namespace=pod.metadata.namespace,
+                                         uid=pod.metadata.uid,
+                                         labels=pod.metadata.labels,
+                                         annotations=pod.metadata.annotations),
+            spec=client.V1PodSpec(containers=[client.V1Container(name=container.name,
+                                                                 resources=container.resources)
+                                              for container in pod.spec.containers],
+                                  node_name=pod.spec.node_name,
+                                  scheduler_name=pod.spec.scheduler_name,
+                                  priority=pod.spec.priority),
+            status=client.V1PodStatus(phase=pod.status.phase))
+
+    def _enqueue(self, event: Dict, delay: float = 0):
+        """ Adds the event to the waiting pods. It supersedes any entry already queued for the same pod. """
+        pod = event['object']
+        with self._queue_cv:
+            seq = next(self._seq)
+            self._queued_seq[pod.metadata.uid] = seq
+            heapq.heappush(self._waiting_pods, (time.time() + delay, -(pod.spec.priority or 0), seq, event))
+            self._queue_cv.notify()
+
+    def _pop_due_events(self):
+        """ Blocks till at least one waiting pod is due and pops the latest event of all due pods. """
+        with self._queue_cv:
+            while not self._waiting_pods or self._waiting_pods[0][0] > time.time():
+                timeout = self._waiting_pods[0][0] - time.time() if self._waiting_pods else None
+                self._queue_cv.wait(timeout)
+            due_events = []
+            now = time.time()
+            while self._waiting_pods and self._waiting_pods[0][0] <= now:
+                _, _, seq, event = heapq.heappop(self._waiting_pods)
+                uid = event['object'].metadata.uid
+                if self._queued_seq.get(uid) == seq:
+                    del self._queued_seq[uid]
+                    due_events.append(event)
+            return due_events
+
+    def _retry_later(self, event: Dict):
+        """ Queues the event again with exponential backoff, unless a newer event for the pod was queued meanwhile. """
+        uid = event['object'].metadata.uid
+        attempts = self._failed_attempts.get(uid, 0) + 1
+        self._failed_attempts[uid] = attempts
+        # _queue_cv uses a reentrant lock, so the check and _enqueue happen atomically
+        with self._queue_cv:
+            if uid not in self._queued_seq:
+                self._enqueue(event, delay=min(2 ** attempts, self.MAX_RETRY_BACKOFF))
+
+    def _forget_pod(self, uid: str):
+        """
+        Drops the retry state and cached requests of a pod which left the wait queue. Pod requests are only parsed
+        while scheduling a batch, so dropping them here on the same thread cannot race with a parse re-adding them.
+        """
+        self._failed_attempts.pop(uid, None)
+        resources.forget_pod_requests(uid)
+
+    def _schedule_batch(self, events: List[Dict]) -> List[Dict]:
+        """
+        Tries to schedule the pods of the events as one batch. Pods are placed by decreasing priority and, within
+        the same priority, largest first (first fit decreasing), which packs nodes better than placing them in arrival
+        order. Every placement speculatively updates the cluster state, so later pods in the batch see the resources
+        consumed by earlier ones.
+        :param events: Watch events, at most one per pod.
+        :return: Events of the pods which could not be placed.
+        """
+        pending_events = []
+        for event in events:
+            pod = event['object']
+            if event['type'] != 'DELETED' and pod.status.phase == 'Pending' and pod.spec.node_name == None and pod.spec.scheduler_name == self.scheduler_name:
+                pending_events.append(event)
+            else:
+                self._forget_pod(pod.metadata.uid)
+                logger.info(f'Ignoring event {event["type"]} for pod {pod.metadata.name}')
+
+        def placement_order(event: Dict):
+            pod = event['object']
+            requests = resources.parse_pod_requests(pod)
+            return -(pod.spec.priority or 0), -(requests.get('cpu', 0) + self.BATCH_MEMORY_WEIGHT * requests.get('memory', 0))
+
+        unscheduled_events = []
+        keyed_events = []
+        for event in pending_events:
+            # Parse the requests of every pod up front, so a pod with requests which cannot be parsed is retried on its
+            # own instead of failing the whole batch
+            try:
+                keyed_events.append((placement_order(event), event))
+            except Exception as e:
+                logger.exception('Unable to parse requests of %s: %s, adding it back to the wait queue.' % (event['object'].metadata.name, str(e)))
+                unscheduled_events.append(event)
+        if not keyed_events:
+            # Most events are status updates of pods which are already bound, skip building the cluster state for them
+            return unscheduled_events
+
+        # Start from a fresh copy of the cache. It includes the pods bound by previous batches, since
+        # _wait_for_bindings waits till they are accounted for. Holding the state lock keeps the ClusterStateUpdater
+        # from replacing the speculated cluster state, and with it the consumption of earlier pods, during the batch.
+        with self._state_lock:
+            self.set_cluster_state(self.cluster_state_updater.get_cluster_state())
+            # sorted() is stable, so pods of the same priority and size keep their arrival order
+            for _, event in sorted(keyed_events, key=lambda keyed_event: keyed_event[0]):
+                ret = self.process_event(event)
+                if ret:
+                    # Event was returned, so it was not scheduled.
+                    unscheduled_events.append(ret)
+        # Pods whose binding failed are retried like pods which could not be placed
+        unscheduled_events.extend(self._wait_for_bindings())
+        return unscheduled_events
+
+    def _watch_pods(self):
+        """ Watches pods in the namespace and adds their events to the waiting pods. """
         w = watch.Watch()
         logger.info('Watch initialized')
-        waiting_objects = deque()   # This queue maintains list of jobs that were not scheduled due to unavailable machines. This list maintains priority order and tries to schedule waiting jobs every time kubernetes state updates.
-        # Start watching for new events
         while True:
             # This while loop is to handle the case when the watch stream is closed due to some error.
             try:
                 stream = w.stream(self.kubecoreapi.list_namespaced_pod, self.namespace)
                 for new_event in stream:
-                    logger.info('Recieved object %s and event type %s, adding to wait queue.' % (new_event['object'].metadata.name, new_event['type']))
-                    if new_event['type'] == 'DELETED':
-                        # If the pod was deleted, force a state update to handle pending pods
-                        logger.info('Pod %s was deleted, forcing state update.' % new_event['object'].metadata.name)
-                        self.set_cluster_state(self.cluster_state_updater.get_cluster_state())
-                    waiting_objects.append(new_event)
-                    num_waiting = len(waiting_objects)
-                    logger.info('Current k8s scheduler wait queue length = %d' % num_waiting)
-                    for i in range(0, num_waiting):
-                        event = waiting_objects.popleft()
-                        if event['object'].status.phase == 'Pending' and event['object'].spec.node_name == None and event['object'].spec.scheduler_name == self.scheduler_name:
-                            ret = self.process_event(event)
-                            if ret:
-                                # Event was returned, so it was not scheduled. Add it back to the queue.
-                                waiting_objects.append(ret)
-                        else:
-                            # limit output size to 100 chars
-                            logger.info(f'Ignoring event {event["type"]} for pod {event["object"].metadata.name}')
-                            pass
+                    pod = new_event['object']
+                    # Waiting pods are retried by the ClusterStateUpdater once it has seen resources being freed
+                    if pod.spec.scheduler_name != self.scheduler_name:
+                        continue
+                    logger.info('Recieved object %s and event type %s, adding to wait queue.' % (pod.metadata.name, new_event['type']))
+                    # Only keep what is needed to schedule the pod. The raw json object is dropped.
+                    self._enqueue({'type': new_event['type'], 'object': self.slim_pod(pod)})
             except Exception as e:
                 logger.exception(f'Exception in watch stream, restarting watch stream. {str(e)}\n Sleeping for {constants.CLUSTER_STATE_RECOVERY_INTERVAL} seconds.')
                 time.sleep(constants.CLUSTER_STATE_RECOVERY_INTERVAL)
                 w = watch.Watch()
                 logger.info('Watch reinitialized')
-                continue
+
+    def run(self):
+        # Wait for cluster state to be populated once before starting the scheduler.
+        while self.cluster_state is None:
+            logger.info('Waiting for cluster state to be populated.')
+            time.sleep(1)
+        logger.info('Cluster state populated, starting scheduler.')
+        # Watch pods in a separate thread so that waiting pods can be retried when their backoff expires
+        threading.Thread(target=self._watch_pods, daemon=True).start()
+        while True:
+            due_events = self._pop_due_events()
+            logger.info('Current k8s scheduler wait queue length = %d' % (len(due_events) + len(self._waiting_pods)))
+            try:
+                for event in self._schedule_batch(due_events):
+                    self._retry_later(event)
+            except Exception as e:
+                # Keep the scheduler running and do not lose the pods of the failed batch
+                logger.exception(f'Exception while scheduling a batch: {e}. Adding its pods back to the wait queue.')
+                for event in due_events:
+                    self._retry_later(event)
@@ -91,3 +91,84 @@ def test_no_cpu_request():
     with pytest.raises(Exception) as e:
         policy.get_allocation(cluster_state, pod)
     assert str(e.value) == 'Pod does not have a resource request for cpu'
+
+
+def test_best_fit_checks_all_requested_resources():
+    policy = BestfitBinpackPolicy('cpu')
+    cluster_state = {
+        'node1': {'cpu': 2.5, 'mem': 1024, 'nvidia.com/gpu': 0},
+        'node2': {'cpu': 3.0, 'mem': 2048, 'nvidia.com/gpu': 1},
+        'node3': {'cpu': 4.0, 'mem': 1024, 'nvidia.com/gpu': 2},
+    }
+
+    # node1 is the best fit for cpu but has no GPUs, so the pod goes to node2
+    pod = V1Pod(
+        spec=V1PodSpec(
+            containers=[
+                V1Container(
+                    name="test-container",
+                    resources=V1ResourceRequirements(
+                        requests={
+                            "cpu": "2",
+                            "nvidia.com/gpu": "1"
+                        }
+                    )
+                )
+            ]
+        )
+    )
+    node, predicted_cluster_state = policy.get_allocation(cluster_state, pod)
+    assert node == 'node2'
+    assert predicted_cluster_state['node2']['cpu'] == 1.0
+    assert predicted_cluster_state['node2']['nvidia.com/gpu'] == 0
+    assert cluster_state['node2']['cpu'] == 3.0
+
+
+def test_best_fit_allocation_on_predicted_cluster_state():
+    policy = BestfitBinpackPolicy('cpu')
+    cluster_state = {
+        'node1': {'cpu': 3.0, 'mem': 1024, 'nvidia.com/gpu': 0},
+        'node2': {'cpu': 2.5, 'mem': 2048, 'nvidia.com/gpu': 0},
+        'node3': {'cpu': 2.6, 'mem': 1024, 'nvidia.com/gpu': 0},
+    }
+
+    # Each allocation is made on the cluster state predicted by the previous one, like the scheduler does
+    allocations = []
+    for _ in range(3):
+        node, cluster_state = policy.get_allocation(cluster_state, create_pod(2.0))
+        allocations.append(node)
+    assert allocations == ['node2', 'node3', 'node1']
+
+    with pytest.raises(Exception) as e:
+        policy.get_allocation(cluster_state, create_pod(2.0))
+    assert str(e.value) == 'No node has enough resources to fit the pod'
+
+
+def test_best_fit_parses_resource_quantities():
+    policy = BestfitBinpackPolicy('memory')
+    cluster_state = {
+        'node1': {'cpu': 0.4, 'memory': 4096, 'nvidia.com/gpu': 0},
+        'node2': {'cpu': 1.0, 'memory': 2048, 'nvidia.com/gpu': 0},
+        'node3': {'cpu': 1.0, 'memory': 1024, 'nvidia.com/gpu': 0},
+    }
+
+    # Requests are Kubernetes quantities, so 500m cpu and 1536Mi memory only fit on node2
+    pod = V1Pod(
+        spec=V1PodSpec(
+            containers=[
+                V1Container(
+                    name="test-container",
+                    resources=V1ResourceRequirements(
+                        requests={
+                            "cpu": "500m",
+                            "memory": "1536Mi"
+                        }
+                    )
+                )
+            ]
+        )
+    )
+    node, predicted_cluster_state = policy.get_allocation(cluster_state, pod)
+    assert node == 'node2'
+    assert predicted_cluster_state['node2']['memory'] == 512
+    assert predicted_cluster_state['node2']['cpu'] == pytest.approx(0.5)
@@ -0,0 +1,178 @@
+import json
+import threading
+
+import pytest
+from kubernetes import client
+
+from chakra import scheduler
+from chakra.scheduler import ClusterStateUpdater
+
+
+def make_node(name, cpu='4', memory='8Gi', gpu='0'):
+    """Helper function to create a raw node dict as received from the list and watch."""
+    return {'metadata': {'name': name},
+            'status': {'allocatable': {'cpu': cpu, 'memory': memory, 'nvidia.com/gpu': gpu}}}
+
+
+def make_pod(uid, node_name, cpu='1', memory='1Gi'):
+    """Helper function to create a raw pod dict as received from the list and watch."""
+    return {'metadata': {'uid': uid},
+            'spec': {'nodeName': node_name,
+                     'containers': [{'resources': {'requests': {'cpu': cpu, 'memory': memory}}}]}}
+
+
+def make_updater():
+    return ClusterStateUpdater(None, None, 'default')
+
+
+def test_sync_builds_cluster_state():
+    updater = make_updater()
+    with updater._lock:
+        updater._sync_nodes([make_node('node1'), make_node('node2', gpu='2')])
+        updater._sync_pods([make_pod('pod1', 'node1'), make_pod('pod2', 'node2', cpu='500m'), make_pod('pod3', None)])
+    assert updater.get_cluster_state() == {'node1': {'cpu': 3, 'memory': 7168, 'nvidia.com/gpu': 0},
+                                           'node2': {'cpu': 3.5, 'memory': 7168, 'nvidia.com/gpu': 2}}
+
+
+def test_pod_events_add_and_remove_usage():
+    updater = make_updater()
+    with updater._lock:
+        updater._sync_nodes([make_node('node1')])
+        updater._sync_pods([])
+        updater._handle_pod_event('ADDED', make_pod('pod1', 'node1'))
+        # Repeated events for an accounted pod must not count it twice
+        updater._handle_pod_event('MODIFIED', make_pod('pod1', 'node1'))
+        updater._handle_pod_event('ADDED', make_pod('pod2', 'node1', cpu='2'))
+    assert updater.get_cluster_state()['node1']['cpu'] == 1
+
+    with updater._lock:
+        updater._handle_pod_event('DELETED', make_pod('pod1', 'node1'))
+        updater._handle_pod_event('DELETED', make_pod('pod1', 'node1'))
+    assert updater.get_cluster_state()['node1'] == {'cpu': 2, 'memory': 7168, 'nvidia.com/gpu': 0}
+
+
+def test_relist_does_not_double_count():
+    updater = make_updater()
+    with updater._lock:
+        updater._sync_nodes([make_node('node1')])
+        updater._sync_pods([make_pod('pod1', 'node1'), make_pod('pod2', 'node1')])
+        # pod2 disappeared while the watch was down
+        updater._sync_nodes([make_node('node1')])
+        updater._sync_pods([make_pod('pod1', 'node1')])
+    assert updater.get_cluster_state() == {'node1': {'cpu': 3, 'memory': 7168, 'nvidia.com/gpu': 0}}
+
+
+def test_node_delete_removes_node():
+    updater = make_updater()
+    with updater._lock:
+        updater._sync_nodes([make_node('node1'), make_node('node2')])
+        updater._sync_pods([make_pod('pod1', 'node2')])
+        updater._handle_node_event('DELETED', make_node('node2'))
+        updater._handle_node_event('ADDED', make_node('node3', cpu='8'))
+    assert updater.get_cluster_state() == {'node1': {'cpu': 4, 'memory': 8192, 'nvidia.com/gpu': 0},
+                                           'node3': {'cpu': 8, 'memory': 8192, 'nvidia.com/gpu': 0}}
+
+
+class StopWatch(BaseException):
+    """Raised by the fakes to end the otherwise endless watch loop. Not an Exception so _watch does not catch it."""
+    pass
+
+
+class FakeResponse:
+    data = '{"items": [], "metadata": {"resourceVersion": "1"}}'
+
+
+def run_failing_watch(monkeypatch, error, attempts):
+    """Runs _watch with a list that always succeeds and a watch that fails right away, returns the sleeps."""
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == attempts:
+            raise StopWatch()
+
+    class FailingWatch:
+        def __init__(self):
+            pass
+
+        def stream(self, func, **kwargs):
+            raise error
+
+    lists = []
+
+    def list_func(**kwargs):
+        lists.append(kwargs)
+        if len(lists) > attempts:
+            raise StopWatch()
+        return FakeResponse(), None, None
+
+    monkeypatch.setattr(scheduler.time, 'sleep', sleep)
+    monkeypatch.setattr(scheduler, 'RawWatch', FailingWatch)
+    updater = make_updater()
+    with pytest.raises(StopWatch):
+        updater._watch(list_func, list_func, lambda objects: None, None, threading.Event())
+    return sleeps, lists
+
+
+def test_watch_failing_after_every_list_backs_off(monkeypatch):
+    sleeps, _ = run_failing_watch(monkeypatch, ConnectionError(), attempts=6)
+    assert sleeps == [3, 6, 12, 24, 30, 30]
+
+
+def test_watch_relists_immediately_on_gone(monkeypatch):
+    sleeps, lists = run_failing_watch(monkeypatch, client.rest.ApiException(status=410, reason='Gone'), attempts=3)
+    assert sleeps == []
+    assert len(lists) == 4
+
+
+def test_capacity_freed_only_when_resources_are_released():
+    updater = make_updater()
+    with updater._lock:
+        updater._sync_nodes([make_node('node1')])
+        updater._sync_pods([])
+        updater._capacity_freed = False
+        updater._handle_pod_event('ADDED', make_pod('pod1', 'node1'))
+        assert not updater._capacity_freed
+        updater._handle_pod_event('DELETED', make_pod('pod1', 'node1'))
+        assert updater._capacity_freed
+
+        updater._capacity_freed = False
+        updater._handle_node_event('ADDED', make_node('node2'))
+        assert updater._capacity_freed
+
+
+def test_raw_watch_keeps_objects_as_dicts():
+    w = scheduler.RawWatch()
+    pod = make_pod('pod1', 'node1')
+    pod['metadata']['resourceVersion'] = '42'
+    event = w.unmarshal_event(json.dumps({'type': 'ADDED', 'object': pod}), 'V1Pod')
+    assert event['object'] == pod
+    # The resource version is tracked so a reconnected stream resumes after the last event
+    assert w.resource_version == '42'
+
+
+def test_wait_for_pods_returns_for_bindings_observed_before_the_wait():
+    updater = make_updater()
+    with updater._lock:
+        updater._sync_nodes([make_node('node1')])
+        updater._sync_pods([])
+    updater.expect_pods(['pod1', 'pod2'])
+    with updater._lock:
+        # pod1 is bound and finishes before the scheduler waits for it
+        updater._handle_pod_event('MODIFIED', make_pod('pod1', 'node1'))
+        updater._handle_pod_event('DELETED', make_pod('pod1', 'node1'))
+    assert updater.wait_for_pods(['pod1'], timeout=0)
+    assert not updater.wait_for_pods(['pod2'], timeout=0)
+    assert updater._expected_pods == {}
+
+
+def test_node_update_with_unchanged_allocatable_is_ignored():
+    updater = make_updater()
+    with updater._lock:
+        updater._sync_nodes([make_node('node1')])
+        updater._dirty.clear()
+        updater._handle_node_event('MODIFIED', make_node('node1'))
+        assert not updater._dirty.is_set()
+        updater._handle_node_event('MODIFIED', make_node('node1', cpu='8'))
+        assert updater._dirty.is_set()
+    assert updater.get_cluster_state()['node1']['cpu'] == 8
@@ -0,0 +1,71 @@
+import pytest
+from kubernetes.client.models import V1Pod, V1ObjectMeta, V1PodSpec, V1Container, V1ResourceRequirements
+
+from chakra.resources import parse_resource_cpu, parse_resource_memory, parse_pod_requests, forget_pod_requests
+
+
+@pytest.mark.parametrize('resource_str, expected', [
+    ('2', 2.0),
+    ('500m', 0.5),
+    ('1.5', 1.5),
+    ('2K', 2000.0),
+])
+def test_parse_resource_cpu(resource_str, expected):
+    assert parse_resource_cpu(resource_str) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('resource_str, expected', [
+    ('512Mi', 512.0),
+    ('1Gi', 1024.0),
+    ('1024Ki', 1.0),
+    ('1.5Gi', 1536.0),
+    ('1048576', 1.0),
+])
+def test_parse_resource_memory(resource_str, expected):
+    assert parse_resource_memory(resource_str) == pytest.approx(expected)
+
+
+def test_parse_pod_requests_is_cached_per_uid():
+    pod = V1Pod(
+        metadata=V1ObjectMeta(uid='test-uid'),
+        spec=V1PodSpec(
+            containers=[
+                V1Container(
+                    name="test-container",
+                    resources=V1ResourceRequirements(
+                        requests={
+                            "cpu": "250m",
+                            "memory": "2Gi",
+                            "nvidia.com/gpu": "1"
+                        }
+                    )
+                )
+            ]
+        )
+    )
+    requests = parse_pod_requests(pod)
+    assert requests == {'cpu': 0.25, 'memory': 2048.0, 'nvidia.com/gpu': 1.0}
+    assert parse_pod_requests(pod) is requests
+
+    forget_pod_requests('test-uid')
+    assert parse_pod_requests(pod) is not requests
+    forget_pod_requests('test-uid')
+
+
+def test_parse_pod_requests_ignores_untracked_resources():
+    pod = V1Pod(
+        spec=V1PodSpec(
+            containers=[
+                V1Container(
+                    name="test-container",
+                    resources=V1ResourceRequirements(
+                        requests={
+                            "cpu": "1",
+                            "ephemeral-storage": "1Gi"
+                        }
+                    )
+                )
+            ]
+        )
+    )
+    assert parse_pod_requests(pod) == {'cpu': 1.0}
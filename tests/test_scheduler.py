@@ -0,0 +1,241 @@
+import time
+
+import pytest
+from kubernetes import client
+from kubernetes.client.models import V1Pod, V1ObjectMeta, V1PodSpec, V1PodStatus, V1Container, V1ResourceRequirements
+
+from chakra import constants, resources
+from chakra.policies import BestfitBinpackPolicy
+from chakra.scheduler import ChakraScheduler
+
+
+def make_event(uid, cpu_request='1', priority=None, event_type='ADDED'):
+    """Helper function to create a watch event for a pending pod."""
+    pod = V1Pod(
+        metadata=V1ObjectMeta(name=uid, uid=uid),
+        spec=V1PodSpec(
+            containers=[
+                V1Container(
+                    name="test-container",
+                    resources=V1ResourceRequirements(
+                        requests={
+                            "cpu": cpu_request
+                        }
+                    )
+                )
+            ],
+            scheduler_name=constants.SCHEDULER_NAME,
+            priority=priority
+        ),
+        status=V1PodStatus(phase='Pending')
+    )
+    return {'type': event_type, 'object': pod}
+
+
+def make_scheduler():
+    """Creates a scheduler without connecting to a cluster or starting the cluster state updater."""
+    chakra = ChakraScheduler.__new__(ChakraScheduler)
+    chakra.policy = BestfitBinpackPolicy()
+    chakra.namespace = 'default'
+    chakra._init_scheduling_state()
+    return chakra
+
+
+class StopScheduler(BaseException):
+    """Raised by the fakes to end the otherwise endless scheduling loop."""
+
+
+def test_run_requeues_pods_of_a_failed_batch():
+    chakra = make_scheduler()
+    chakra.cluster_state = {}
+    chakra._watch_pods = lambda: None
+    event = make_event('pod1')
+    batches = [[event]]
+
+    def pop_due_events():
+        if not batches:
+            raise StopScheduler()
+        return batches.pop()
+
+    def schedule_batch(events):
+        raise ConnectionError()
+
+    chakra._pop_due_events = pop_due_events
+    chakra._schedule_batch = schedule_batch
+    with pytest.raises(StopScheduler):
+        chakra.run()
+    assert 'pod1' in chakra._queued_seq
+    assert chakra._failed_attempts == {'pod1': 1}
+
+
+def test_enqueue_supersedes_older_entries_of_the_pod():
+    chakra = make_scheduler()
+    added = make_event('pod1')
+    modified = make_event('pod1', event_type='MODIFIED')
+    chakra._enqueue(added)
+    chakra._enqueue(make_event('pod2'))
+    chakra._enqueue(modified)
+    due_events = chakra._pop_due_events()
+    # The stale entry of pod1 is skipped, only its latest event is returned
+    assert [event['object'].metadata.uid for event in due_events] == ['pod2', 'pod1']
+    assert due_events[1] is modified
+    assert chakra._waiting_pods == [] and chakra._queued_seq == {}
+
+
+def test_pop_due_events_skips_pods_not_due():
+    chakra = make_scheduler()
+    chakra._enqueue(make_event('later'), delay=100)
+    chakra._enqueue(make_event('now'))
+    assert [event['object'].metadata.uid for event in chakra._pop_due_events()] == ['now']
+    assert list(chakra._queued_seq) == ['later']
+
+
+def test_pods_due_at_the_same_time_are_popped_by_priority():
+    chakra = make_scheduler()
+    chakra._enqueue(make_event('low', priority=1))
+    chakra._enqueue(make_event('high', priority=10))
+    chakra._enqueue(make_event('none'))
+    # Makes all pods due at the same time
+    chakra.retry_waiting_pods()
+    assert [event['object'].metadata.uid for event in chakra._pop_due_events()] == ['high', 'low', 'none']
+
+
+def test_retry_waiting_pods_makes_them_due():
+    chakra = make_scheduler()
+    chakra._enqueue(make_event('pod1'), delay=100)
+    chakra.retry_waiting_pods()
+    assert [event['object'].metadata.uid for event in chakra._pop_due_events()] == ['pod1']
+
+
+def test_retry_later_backs_off_exponentially():
+    chakra = make_scheduler()
+    event = make_event('pod1')
+    for attempts in range(1, 7):
+        chakra._retry_later(event)
+        next_attempt_time = chakra._waiting_pods[0][0]
+        assert next_attempt_time - time.time() == pytest.approx(min(2 ** attempts, ChakraScheduler.MAX_RETRY_BACKOFF), abs=1)
+        chakra._waiting_pods.clear()
+        chakra._queued_seq.clear()
+    assert chakra._failed_attempts == {'pod1': 6}
+
+
+def test_retry_later_keeps_newer_events():
+    chakra = make_scheduler()
+    modified = make_event('pod1', event_type='MODIFIED')
+    chakra._enqueue(modified)
+    chakra._retry_later(make_event('pod1'))
+    assert len(chakra._waiting_pods) == 1
+    assert chakra._pop_due_events() == [modified]
+
+
+class FakeClusterStateUpdater:
+    def __init__(self, cluster_state=None):
+        self.cluster_state = cluster_state
+        self.expected_uids = []
+        self.forgotten_uids = []
+        self.waited_uids = []
+
+    def get_cluster_state(self):
+        return self.cluster_state
+
+    def expect_pods(self, uids):
+        self.expected_uids.extend(uids)
+
+    def forget_expected_pods(self, uids):
+        self.forgotten_uids.extend(uids)
+
+    def wait_for_pods(self, uids, timeout):
+        self.waited_uids.extend(uids)
+        return True
+
+
+class FakeAsyncResult:
+    def __init__(self, error=None):
+        self.error = error
+
+    def get(self):
+        if self.error:
+            raise self.error
+
+
+def test_schedule_batch_places_pods_by_priority_then_first_fit_decreasing():
+    chakra = make_scheduler()
+    chakra.cluster_state_updater = FakeClusterStateUpdater({'node1': {'cpu': 8, 'memory': 8192, 'nvidia.com/gpu': 0}})
+    bound = []
+
+    def schedule(name, node):
+        bound.append(name)
+        return FakeAsyncResult()
+
+    chakra.schedule = schedule
+    events = [make_event('small', '1'), make_event('large', '3'), make_event('medium', '2'),
+              make_event('urgent', '500m', priority=10), make_event('unparsable', 'abc'),
+              make_event('deleted', '1', event_type='DELETED')]
+    unscheduled_events = chakra._schedule_batch(events)
+    assert bound == ['urgent', 'large', 'medium', 'small']
+    assert [event['object'].metadata.uid for event in unscheduled_events] == ['unparsable']
+    assert chakra.cluster_state['node1']['cpu'] == pytest.approx(1.5)
+
+
+def make_api_exception(status, reason, body):
+    e = client.rest.ApiException(status=status, reason=reason)
+    e.body = body
+    return e
+
+
+def test_failed_bindings_are_retried():
+    chakra = make_scheduler()
+    chakra.cluster_state_updater = FakeClusterStateUpdater({'node1': {'cpu': 8, 'memory': 8192, 'nvidia.com/gpu': 0}})
+    binding_errors = {
+        'refused': ConnectionError('Max retries exceeded'),
+        # Plain text body, e.g. from a proxy in front of the apiserver
+        'unavailable': make_api_exception(503, 'Service Unavailable', 'upstream connect error'),
+        'already-bound': make_api_exception(409, 'Conflict', None),
+    }
+    chakra.schedule = lambda name, node: FakeAsyncResult(binding_errors.get(name))
+    events = [make_event(uid) for uid in ('refused', 'bound', 'unavailable', 'already-bound')]
+    for event in chakra._schedule_batch(events):
+        chakra._retry_later(event)
+    assert chakra._pending_bindings == []
+    assert sorted(chakra.cluster_state_updater.forgotten_uids) == ['already-bound', 'refused', 'unavailable']
+    assert chakra.cluster_state_updater.waited_uids == ['bound']
+    # Pods whose binding failed are queued again, the others left the queue
+    assert sorted(chakra._queued_seq) == ['refused', 'unavailable']
+    assert chakra._failed_attempts == {'refused': 1, 'unavailable': 1}
+
+    # Later batches do not see the bindings of earlier ones again
+    binding_errors.clear()
+    assert chakra._schedule_batch([make_event('refused'), make_event('unavailable')]) == []
+    assert chakra._pending_bindings == []
+    assert chakra._failed_attempts == {}
+
+
+def test_schedule_batch_forgets_requests_of_pods_leaving_the_queue():
+    chakra = make_scheduler()
+    chakra.cluster_state_updater = FakeClusterStateUpdater({'node1': {'cpu': 2, 'memory': 8192, 'nvidia.com/gpu': 0}})
+    chakra.schedule = lambda name, node: FakeAsyncResult()
+    events = [make_event('fits', '1'), make_event('too-large', '4'), make_event('gone', '1', event_type='DELETED')]
+    resources.parse_pod_requests(events[2]['object'])
+    chakra._schedule_batch(events)
+    assert 'fits' not in resources._pod_requests_cache
+    assert 'gone' not in resources._pod_requests_cache
+    # The pod which is retried keeps its parsed requests
+    assert 'too-large' in resources._pod_requests_cache
+    resources.forget_pod_requests('too-large')
+
+
+def test_schedule_batch_without_pending_pods_skips_the_cluster_state():
+    chakra = make_scheduler()
+
+    class FailingClusterStateUpdater(FakeClusterStateUpdater):
+        def get_cluster_state(self):
+            raise AssertionError('Cluster state should not be built')
+
+        def wait_for_pods(self, uids, timeout):
+            raise AssertionError('Bindings should not be waited for')
+
+    chakra.cluster_state_updater = FailingClusterStateUpdater()
+    bound = make_event('bound', event_type='MODIFIED')
+    bound['object'].spec.node_name = 'node1'
+    assert chakra._schedule_batch([bound, make_event('gone', event_type='DELETED')]) == []
+    assert chakra._schedule_batch([make_event('unparsable', 'abc')])[0]['object'].metadata.uid == 'unparsable'